@@ -1,4 +1,5 @@
 from .middleware import MagicFieldsMiddleware
+from .pipeline import MagicFieldsPipeline
 
 
 __version__ = "1.1.0"
@@ -0,0 +1,161 @@
+"""Rendering of parsed MAGIC_FIELDS templates.
+
+This module holds the per-item hot path only, and is kept free of Scrapy
+imports so that it can be compiled with mypyc (see setup.py). Templates
+are parsed by ``scrapy_magicfields.middleware._parse()``.
+"""
+import logging
+
+MYPY = False
+if MYPY:
+    from typing import Any, Callable, Dict, List, Optional, Pattern, Set, Tuple, Union
+    Handler = Callable[[Any, Any, Any, Any, Dict[str, Any]], Optional[str]]
+    Token = Tuple[Handler, Any, Optional[Pattern], str]
+    Segment = Union[str, Token]
+
+
+logger = logging.getLogger(__name__)
+
+
+def _as_str(value):
+    # type: (Any) -> str
+    return value if type(value) is str else str(value)
+
+class _Unresolved(Exception):
+    """Raised by entity handlers when a magic cannot be substituted."""
+
+# Entity handlers are called as ``handler(arg, spider, response, item,
+# fixed_values)`` and return the substituted text, or None to leave the
+# magic as it is. ``arg`` is the magic argument as prepared by _parse(),
+# which already checked that it is present when required.
+
+def _h_jobid(arg, spider, response, item, fv):
+    # type: (Any, Any, Any, Any, Dict[str, Any]) -> Optional[str]
+    return fv["$jobid"]
+
+def _h_jobtime(arg, spider, response, item, fv):
+    # type: (Any, Any, Any, Any, Dict[str, Any]) -> Optional[str]
+    return fv.get("$jobtime")
+
+def _h_spider(arg, spider, response, item, fv):
+    # type: (Any, Any, Any, Any, Dict[str, Any]) -> Optional[str]
+    try:
+        return _as_str(arg(spider))
+    except AttributeError:
+        raise _Unresolved("spider does not have attribute")
+
+def _h_response(arg, spider, response, item, fv):
+    # type: (Any, Any, Any, Any, Dict[str, Any]) -> Optional[str]
+    try:
+        return _as_str(arg(response))
+    except AttributeError:
+        raise _Unresolved("response does not have attribute")
+
+def _h_field(arg, spider, response, item, fv):
+    # type: (Any, Any, Any, Any, Dict[str, Any]) -> Optional[str]
+    if arg in item:
+        return _as_str(item[arg])
+    return None
+
+def _h_setting(arg, spider, response, item, fv):
+    # type: (Any, Any, Any, Any, Dict[str, Any]) -> Optional[str]
+    settings = fv.get("$setting")
+    if settings is not None:
+        return _as_str(settings[arg])
+    return None
+
+def _h_env(arg, spider, response, item, fv):
+    # type: (Any, Any, Any, Any, Dict[str, Any]) -> Optional[str]
+    return fv[arg]
+
+def _h_time(arg, spider, response, item, fv):
+    # type: (Any, Any, Any, Any, Dict[str, Any]) -> Optional[str]
+    return fv["$time"]
+
+def _h_unixtime(arg, spider, response, item, fv):
+    # type: (Any, Any, Any, Any, Dict[str, Any]) -> Optional[str]
+    return fv["$unixtime"]
+
+def _h_isotime(arg, spider, response, item, fv):
+    # type: (Any, Any, Any, Any, Dict[str, Any]) -> Optional[str]
+    return fv["$isotime"]
+
+_ENTITY_HANDLERS = {
+    'jobid': _h_jobid,
+    'jobtime': _h_jobtime,
+    'spider': _h_spider,
+    'response': _h_response,
+    'field': _h_field,
+    'setting': _h_setting,
+    'env': _h_env,
+    'time': _h_time,
+    'unixtime': _h_unixtime,
+    'isotime': _h_isotime,
+}  # type: Dict[str, Handler]
+
+_TIME_HANDLERS = frozenset([_h_time, _h_unixtime, _h_isotime])
+# handlers whose value is known once the middleware is created
+_INIT_HANDLERS = frozenset([_h_jobid, _h_jobtime, _h_setting, _h_env])
+# handlers whose value is the same for all items of a response
+_RESPONSE_HANDLERS = _INIT_HANDLERS.union(_TIME_HANDLERS, [_h_spider, _h_response])
+
+def _extract_regex_group(regex, txt):
+    # type: (Pattern, str) -> Optional[str]
+    m = regex.search(txt)
+    if m:
+        return "".join(m.groups()) or None
+    return None
+
+def _warn_once(warned, source, message):
+    # type: (Set[str], str, Any) -> None
+    if source not in warned:
+        warned.add(source)
+        logger.warning("Error at '%s': %s", source, message)
+
+def _substitute(token, spider, response, item, fixed_values, warned):
+    # type: (Token, Any, Any, Any, Dict[str, Any], Set[str]) -> str
+    handler, arg, regex, source = token
+    try:
+        val = handler(arg, spider, response, item, fixed_values)
+    except _Unresolved as e:
+        val = None
+        _warn_once(warned, source, e)
+    return source if val is None else val
+
+def _render(segments, spider, response, item, fixed_values, warned):
+    # type: (List[Segment], Any, Any, Any, Dict[str, Any], Set[str]) -> Optional[str]
+    parts = []  # type: List[str]
+    out = None  # type: Optional[str]
+    for i, segment in enumerate(segments):
+        if not isinstance(segment, tuple):
+            if out is None:
+                parts.append(segment)
+            continue
+        val = _substitute(segment, spider, response, item, fixed_values, warned)
+        if out is None:
+            parts.append(val)
+        else:
+            out = out.replace(segment[3], val, 1)
+        regex = segment[2]
+        if regex:
+            if out is None:
+                # the regex applies to the whole output, later magics
+                # included as they are; they are then substituted into
+                # its result, wherever their text still appears
+                parts.extend(s[3] if isinstance(s, tuple) else s for s in segments[i + 1:])
+                out = "".join(parts)
+            out = _extract_regex_group(regex, out)
+            if out is None:
+                return None
+
+    return "".join(parts) if out is None else out
+
+def _render_single(template, spider, response, item, fixed_values, warned):
+    # type: (Tuple[str, Token, str], Any, Any, Any, Dict[str, Any], Set[str]) -> Optional[str]
+    """Render a ``(prefix, token, suffix)`` template, see _specialize()."""
+    prefix, token, suffix = template
+    out = prefix + _substitute(token, spider, response, item, fixed_values, warned) + suffix
+    regex = token[2]
+    if regex:
+        return _extract_regex_group(regex, out)
+    return out
@@ -1,102 +1,139 @@
 import datetime
 import logging
+import operator
 import os
 import re
+import sys
 import time
 
 from scrapy.exceptions import NotConfigured
 from scrapy.item import BaseItem
 
+from ._render import (
+    _ENTITY_HANDLERS, _INIT_HANDLERS, _RESPONSE_HANDLERS, _TIME_HANDLERS,
+    _h_env, _h_jobid, _h_response, _render, _render_single,
+)
+
 
 logger = logging.getLogger(__name__)
 
+if sys.version_info[0] >= 3:
+    _intern = sys.intern
+else:
+    _intern = intern
+
 
 def _time():
     return datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
 
-def _isotime():
-    return datetime.datetime.utcnow().isoformat()
-
-_REGEXES = {}
-_REGEX_ERRORS = {}
-def _extract_regex_group(regex, txt):
-    compiled = _REGEXES.get(regex)
-    errmessage = _REGEX_ERRORS.get(regex)
-    if compiled is None and errmessage is None:
-        try:
-            compiled = re.compile(regex)
-            _REGEXES[regex] = compiled
-        except Exception as e:
-            errmessage = e.message
-            _REGEX_ERRORS[regex] = errmessage
-    if errmessage:
-        raise ValueError(errmessage)
-    m = compiled.search(txt)
-    if m:
-        return "".join(m.groups()) or None
-
-_ENTITY_FUNCTION_MAP = {
-    '$time': _time,
-    '$unixtime': time.time,
-    '$isotime': _isotime,
-}
-
-_ENTITIES_RE = re.compile("(\$[a-z]+)(:\w+)?(?:,r\'(.+)\')?")
-def _first_arg(args):
-    if args:
-        return args.pop(0)
-
-def _format(fmt, spider, response, item, fixed_values):
-    out = fmt
+def _time_values():
+    """Timestamps for the time entities, taken once for a whole response."""
+    now = datetime.datetime.utcnow()
+    return {
+        '$time': now.strftime('%Y-%m-%d %H:%M:%S'),
+        '$unixtime': str(time.time()),
+        '$isotime': now.isoformat(),
+    }
+
+_ENTITIES_RE = re.compile(
+    r"\$(time|unixtime|isotime|spider|env|jobid|jobtime|response|setting|field)(?![a-z])"
+    r"(?::(\w+))?(?:,r'([^']+)')?")
+# anything else looking like a magic
+_UNKNOWN_ENTITIES_RE = re.compile(r"\$[a-z]+")
+
+_ARG_REQUIRED = frozenset(['spider', 'response', 'field', 'setting', 'env'])
+_NO_ARG = frozenset(['time', 'unixtime', 'isotime'])
+
+def _append_literal(segments, text):
+    """Append ``text`` to ``segments``, merging it with a trailing literal."""
+    if not text:
+        return
+    if segments and not isinstance(segments[-1], tuple):
+        segments[-1] += text
+    else:
+        segments.append(text)
+
+def _check_literal(text):
+    for m in _UNKNOWN_ENTITIES_RE.finditer(text):
+        logger.warning("Error at '%s': unknown magic", m.group())
+    return text
+
+def _parse(fmt):
+    """Split ``fmt`` into a list of literal strings and entity tokens.
+
+    Tokens are ``(handler, arg, regex, source)`` tuples, ``handler`` being
+    the entity handler, ``regex`` the compiled output regex (if any) and
+    ``source`` the original magic text, kept for substitution failures and
+    warnings. ``$spider`` and ``$response`` arguments are replaced by their
+    attribute getter, and ``$env`` ones by their key in ``fixed_values``.
+    Adjacent literals are merged, so that rendering joins as few parts as
+    possible.
+
+    Unknown magics, and magics missing their argument or given one they
+    do not accept, are logged and kept as literal text.
+    """
+    if '$' not in fmt:
+        return [fmt] if fmt else []
+    segments = []
+    last_end = 0
     for m in _ENTITIES_RE.finditer(fmt):
-        val = None
-        entity, args, regex = m.groups()
-        args = list(filter(None, (args or ':')[1:].split(',')))
-        if entity == "$jobid":
-            val = os.environ.get('SCRAPY_JOB', '')
-        elif entity == "$spider":
-            attr = _first_arg(args)
-            if not attr or not hasattr(spider, attr):
-                logger.warning("Error at '%s': spider does not have attribute" % m.group())
-            else:
-                val = str(getattr(spider, attr))
-        elif entity == "$response":
-            attr = _first_arg(args)
-            if not attr or not hasattr(response, attr):
-                logger.warning("Error at '%s': response does not have attribute" % m.group())
-            else:
-                val = str(getattr(response, attr))
-        elif entity == "$field":
-            attr = _first_arg(args)
-            if attr in item:
-                val = str(item[attr])
-        elif entity in fixed_values:
-            attr = _first_arg(args)
-            val = fixed_values[entity]
-            if entity == "$setting" and attr:
-                val = str(val[attr])
-        elif entity == "$env" and args:
-            attr = _first_arg(args)
-            if attr:
-                val = os.environ.get(attr, '')
-        else:
-            function = _ENTITY_FUNCTION_MAP.get(entity)
-            if function is not None:
-                try:
-                    val = str(function(*args))
-                except:
-                    logger.warning("Error at '%s': invalid argument for function" % m.group())
-        if val is not None:
-            out = out.replace(m.group(), val, 1)
+        entity, arg, regex = m.groups()
+        _append_literal(segments, _check_literal(fmt[last_end:m.start()]))
+        last_end = m.end()
+        if entity in _ARG_REQUIRED and not arg:
+            logger.warning("Error at '%s': missing argument", m.group())
+            _append_literal(segments, m.group())
+            continue
+        if entity in _NO_ARG and arg:
+            logger.warning("Error at '%s': invalid argument for function", m.group())
+            _append_literal(segments, m.group())
+            continue
+        if arg and entity in ('spider', 'response'):
+            arg = operator.attrgetter(arg)
+        elif arg and entity == 'env':
+            arg = "$env:" + arg
         if regex:
             try:
-                out = _extract_regex_group(regex, out)
-            except ValueError as e:
-                logger.warning("Error at '%s': %s" % (m.group(), e.message))
+                regex = re.compile(regex)
+            except re.error as e:
+                raise ValueError("Error at '%s': %s" % (m.group(), e))
+        segments.append((_ENTITY_HANDLERS[entity], arg, regex, m.group()))
+    _append_literal(segments, _check_literal(fmt[last_end:]))
+    return segments
+
+def _environ_values(segments):
+    """Read the environment variables referenced by ``segments``."""
+    values = {}
+    for segment in segments:
+        if isinstance(segment, tuple):
+            handler, arg = segment[:2]
+            if handler is _h_jobid:
+                values["$jobid"] = os.environ.get('SCRAPY_JOB', '')
+            elif handler is _h_env:
+                values[arg] = os.environ.get(arg[len("$env:"):], '')
+    return values
+
+def _specialize(segments):
+    """Return a ``(renderer, template)`` pair for parsed ``segments``.
+
+    Templates holding a single magic are rendered by concatenating their
+    prefix, value and suffix, without going through the generic loop.
+    """
+    positions = [i for i, segment in enumerate(segments) if isinstance(segment, tuple)]
+    if len(positions) == 1:
+        i = positions[0]
+        return _render_single, ("".join(segments[:i]), segments[i], "".join(segments[i + 1:]))
+    return _render, segments
 
-    return out
+def _format(fmt, spider, response, item, fixed_values):
+    segments = _parse(fmt)
+    values = dict(fixed_values)
+    values.update(_environ_values(segments))
+    values.update(_time_values())
+    return _render(segments, spider, response, item, values, set())
 
-class MagicFieldsMiddleware(object):
+class _MagicFields(object):
+    """Parsed ``MAGIC_FIELDS``, shared by the middleware and the pipeline."""
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -112,11 +149,71 @@ class MagicFieldsMiddleware(object):
             "$jobtime": _time(),
             "$setting": settings,
         }
+        self._warned = set()
+        self.static_fields = {}
+        self.response_fields = {}
+        self.dynamic_fields = {}
+        self.uses_time = False
+        # fields with $response magics, which the pipeline cannot render
+        self.response_magic_fields = set()
+        for field, fmt in mfields.items():
+            if type(field) is str:
+                # items are mostly keyed by interned literals, making
+                # setdefault() lookups an identity check
+                field = _intern(field)
+            segments = _parse(fmt)
+            self.fixed_values.update(_environ_values(segments))
+            handlers = set(segment[0] for segment in segments if isinstance(segment, tuple))
+            if _h_response in handlers:
+                self.response_magic_fields.add(field)
+            if handlers <= _INIT_HANDLERS:
+                self.static_fields[field] = _render(
+                    segments, None, None, None, self.fixed_values, self._warned)
+                continue
+            if handlers <= _RESPONSE_HANDLERS:
+                self.response_fields[field] = _specialize(segments)
+            else:
+                self.dynamic_fields[field] = _specialize(segments)
+            self.uses_time = self.uses_time or bool(handlers & _TIME_HANDLERS)
+
+    def _values(self):
+        """Return ``fixed_values``, with timestamps when templates need them."""
+        values = self.fixed_values
+        if self.uses_time:
+            values = dict(values)
+            values.update(_time_values())
+        return values
+
+
+class MagicFieldsMiddleware(_MagicFields):
+
+    def __init__(self, mfields, settings):
+        super(MagicFieldsMiddleware, self).__init__(mfields, settings)
+        # whether objects of a given type are items, filled in as types show up
+        self._item_types = {dict: True}
 
     def process_spider_output(self, response, result, spider):
+        values = None
+        # static and response fields, rendered when the first item shows up
+        constant_fields = None
+        dynamic_fields = [(field, render, template)
+                          for field, (render, template) in self.dynamic_fields.items()]
+        warned = self._warned
+        item_types = self._item_types
         for _res in result:
-            if isinstance(_res, (BaseItem, dict)):
-                for field, fmt in self.mfields.items():
-                    _res.setdefault(field, _format(fmt, spider, response, _res, self.fixed_values))
+            is_item = item_types.get(type(_res))
+            if is_item is None:
+                is_item = item_types[type(_res)] = isinstance(_res, (BaseItem, dict))
+            if is_item:
+                if constant_fields is None:
+                    values = self._values()
+                    constant_fields = list(self.static_fields.items())
+                    for field, (render, template) in self.response_fields.items():
+                        constant_fields.append(
+                            (field, render(template, spider, response, None, values, warned)))
+                setdefault = _res.setdefault
+                for field, value in constant_fields:
+                    setdefault(field, value)
+                for field, render, template in dynamic_fields:
+                    setdefault(field, render(template, spider, response, _res, values, warned))
             yield _res
-
@@ -0,0 +1,39 @@
+import logging
+
+from scrapy.item import BaseItem
+
+from .middleware import _MagicFields
+
+
+logger = logging.getLogger(__name__)
+
+
+class MagicFieldsPipeline(_MagicFields):
+    """Item pipeline alternative to MagicFieldsMiddleware.
+
+    Item pipelines only receive items, so requests yielded by spiders do not
+    go through any magic fields code. There is no response at this stage:
+    fields using ``$response`` magics are skipped, and timestamps are taken
+    for each item.
+    """
+
+    def __init__(self, mfields, settings):
+        super(MagicFieldsPipeline, self).__init__(mfields, settings)
+        for field in sorted(self.response_magic_fields):
+            logger.warning("Magic field '%s' uses $response, which "
+                           "MagicFieldsPipeline cannot fill: skipping it", field)
+            self.response_fields.pop(field, None)
+            self.dynamic_fields.pop(field, None)
+
+    def process_item(self, item, spider):
+        if not isinstance(item, (BaseItem, dict)):
+            return item
+        values = self._values()
+        warned = self._warned
+        setdefault = item.setdefault
+        for field, value in self.static_fields.items():
+            setdefault(field, value)
+        for fields in (self.response_fields, self.dynamic_fields):
+            for field, (render, template) in fields.items():
+                setdefault(field, render(template, spider, None, item, values, warned))
+        return item
@@ -1,5 +1,15 @@
+import os
+
 from setuptools import setup
 
+
+# Optionally compile the item rendering module to a C extension with mypyc.
+# The pure Python module is used when it is not built.
+ext_modules = []
+if os.environ.get('SCRAPY_MAGICFIELDS_MYPYC'):
+    from mypyc.build import mypycify
+    ext_modules = mypycify(['--ignore-missing-imports', 'scrapy_magicfields/_render.py'])
+
 setup(
     name='scrapy-magicfields',
     version='1.1.0',
@@ -9,6 +19,7 @@ setup(
     author_email='info@scrapinghub.com',
     url='http://github.com/scrapy-plugins/scrapy-magicfields',
     packages=['scrapy_magicfields'],
+    ext_modules=ext_modules,
     platforms=['Any'],
     classifiers=[
         'Development Status :: 4 - Beta',
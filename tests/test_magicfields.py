@@ -1,14 +1,15 @@
 from __future__ import print_function
 import re, os
+import logging
 from unittest import TestCase
 
 from scrapy.spiders import Spider
 from scrapy.utils.test import get_crawler
 from scrapy.item import DictItem, Field
-from scrapy.http import HtmlResponse
+from scrapy.http import HtmlResponse, Request
 
-from scrapy_magicfields import MagicFieldsMiddleware
-from scrapy_magicfields.middleware import _format
+from scrapy_magicfields import MagicFieldsMiddleware, MagicFieldsPipeline
+from scrapy_magicfields.middleware import _format, _parse
 
 
 class TestItem(DictItem):
@@ -78,6 +79,19 @@ class MagicFieldsTest(TestCase):
         formatted = _format("Item scraped at $myentity", self.spider, self.response, self.item, {})
         self.assertEqual(formatted, 'Item scraped at $myentity')
 
+    def test_notexisting_prefix(self):
+        """Entities only match whole magic names"""
+        formatted = _format("Item scraped at $timestamp", self.spider, self.response, self.item, {})
+        self.assertEqual(formatted, 'Item scraped at $timestamp')
+
+    def test_parse_merges_literals(self):
+        self.assertEqual(_parse("Item scraped at $myentity!"), ["Item scraped at $myentity!"])
+        self.assertEqual(_parse(""), [])
+
+    def test_parse_invalid_magics(self):
+        """Magics that can never be substituted are kept as literals"""
+        self.assertEqual(_parse("$spider and $unixtime:arg"), ["$spider and $unixtime:arg"])
+
     def test_noargs(self):
         """If entity does not accept arguments, don't substitute"""
         formatted = _format("Scraped on day $unixtime:arg", self.spider, self.response, self.item, {})
@@ -97,6 +111,15 @@ class MagicFieldsTest(TestCase):
         formatted = _format("$env:TEST_ENV", self.spider, self.response, self.item, {})
         self.assertEqual(formatted, "testval")
 
+    def test_mware_environment(self):
+        os.environ["TEST_ENV"] = "testval"
+        settings = {"MAGIC_FIELDS": {"sku": "$env:TEST_ENV"}}
+        crawler = get_crawler(settings_dict=settings)
+        mware = MagicFieldsMiddleware.from_crawler(crawler)
+        os.environ["TEST_ENV"] = "changed"
+        result = list(mware.process_spider_output(self.response, [self.item], self.spider))[0]
+        self.assertEqual(result['sku'], 'testval')
+
     def test_response(self):
         formatted = _format("$response:url", self.spider, self.response, self.item, {})
         self.assertEqual(formatted, self.response.url)
@@ -109,6 +132,25 @@ class MagicFieldsTest(TestCase):
         formatted = _format("$field:url,r'item_no=(\d+)'", self.spider, self.response, self.item, {})
         self.assertEqual(formatted, '345')
 
+    def test_regex_whole_output(self):
+        """The regex applies to the whole output, and only its groups are kept"""
+        formatted = _format("id $field:url,r'item_no=(\d+)' end", self.spider, self.response, self.item, {})
+        self.assertEqual(formatted, '345')
+        formatted = _format("$field:url,r'item_no=(\d+)' and $field:nom", self.spider, self.response, self.item, {})
+        self.assertEqual(formatted, '345')
+        formatted = _format("$spider:arg1,r'v(a)l'x", self.spider, self.response, self.item, {})
+        self.assertEqual(formatted, 'a')
+
+    def test_regex_later_magics(self):
+        """Magics after a regex are substituted into its result"""
+        formatted = _format("$field:url,r'(.*)' $spider:name", self.spider, self.response, self.item, {})
+        self.assertEqual(formatted, 'http://www.example.com/product.html?item_no=345 myspider')
+
+    def test_invalid_regex(self):
+        settings = {"MAGIC_FIELDS": {"sku": "$field:url,r'item_no=(\d+'"}}
+        crawler = get_crawler(settings_dict=settings)
+        self.assertRaises(ValueError, MagicFieldsMiddleware.from_crawler, crawler)
+
     def test_mware(self):
         settings = {"MAGIC_FIELDS": {"spider": "$spider:name"}}
         crawler = get_crawler(settings_dict=settings)
@@ -122,6 +164,89 @@ class MagicFieldsTest(TestCase):
         }
         self.assertEqual(result, expected)
 
+    def test_mware_static(self):
+        settings = {"MAGIC_FIELDS": {"spider": "$spider:name", "sku": "no magic here"}}
+        crawler = get_crawler(settings_dict=settings)
+        mware = MagicFieldsMiddleware.from_crawler(crawler)
+        self.assertEqual(mware.static_fields, {"sku": "no magic here"})
+        self.assertEqual(list(mware.response_fields), ["spider"])
+        result = list(mware.process_spider_output(self.response, [self.item], self.spider))[0]
+        self.assertEqual(result['sku'], 'no magic here')
+        self.assertEqual(result['spider'], 'myspider')
+
+    def test_mware_init_values(self):
+        os.environ["SCRAPY_JOB"] = 'aa788'
+        settings = {"MAGIC_FIELDS": {"sku": "job $jobid", "spider": "$setting:BOT_NAME"}}
+        crawler = get_crawler(settings_dict=settings)
+        mware = MagicFieldsMiddleware.from_crawler(crawler)
+        self.assertEqual(mware.static_fields, {"sku": "job aa788", "spider": "scrapybot"})
+        self.assertEqual(mware.dynamic_fields, {})
+
+    def test_mware_single_magic(self):
+        settings = {"MAGIC_FIELDS": {
+            "sku": "id $field:url,r'item_no=(\d+)' end",
+            "spider": "<$spider:name>",
+        }}
+        crawler = get_crawler(settings_dict=settings)
+        mware = MagicFieldsMiddleware.from_crawler(crawler)
+        result = list(mware.process_spider_output(self.response, [self.item], self.spider))[0]
+        self.assertEqual(result['sku'], '345')
+        self.assertEqual(result['spider'], '<myspider>')
+
+    def test_mware_field_kinds(self):
+        settings = {"MAGIC_FIELDS": {
+            "sku": "$field:nom",
+            "spider": "$spider:name at $time",
+            "url": "$response:url",
+        }}
+        crawler = get_crawler(settings_dict=settings)
+        mware = MagicFieldsMiddleware.from_crawler(crawler)
+        self.assertEqual(sorted(mware.response_fields), ["spider", "url"])
+        self.assertEqual(list(mware.dynamic_fields), ["sku"])
+        items = [{"nom": "first"}, {"nom": "second"}]
+        result = list(mware.process_spider_output(self.response, items, self.spider))
+        self.assertEqual([r['sku'] for r in result], ["first", "second"])
+        self.assertEqual(result[0]['url'], self.response.url)
+        self.assertEqual(result[0]['spider'], result[1]['spider'])
+
+    def test_mware_time_per_response(self):
+        settings = {"MAGIC_FIELDS": {"sku": "$unixtime", "spider": "$isotime"}}
+        crawler = get_crawler(settings_dict=settings)
+        mware = MagicFieldsMiddleware.from_crawler(crawler)
+        items = [dict(self.item), dict(self.item)]
+        result = list(mware.process_spider_output(self.response, items, self.spider))
+        self.assertRegexpMatches(result[0]['sku'], '\d+\.\d+$')
+        self.assertEqual(result[0]['sku'], result[1]['sku'])
+        self.assertEqual(result[0]['spider'], result[1]['spider'])
+
+    def test_mware_warns_once(self):
+        settings = {"MAGIC_FIELDS": {"sku": "$spider:arg2"}}
+        crawler = get_crawler(settings_dict=settings)
+        mware = MagicFieldsMiddleware.from_crawler(crawler)
+        items = [dict(self.item), dict(self.item)]
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('scrapy_magicfields')
+        logger.addHandler(handler)
+        try:
+            result = list(mware.process_spider_output(self.response, items, self.spider))
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(result[1]['sku'], '$spider:arg2')
+
+    def test_mware_requests(self):
+        settings = {"MAGIC_FIELDS": {"spider": "$spider:name"}}
+        crawler = get_crawler(settings_dict=settings)
+        mware = MagicFieldsMiddleware.from_crawler(crawler)
+        request = Request("http://www.example.com/product/2")
+        result = list(mware.process_spider_output(
+            self.response, [request, self.item, request], self.spider))
+        self.assertEqual(result, [request, self.item, request])
+        self.assertEqual(result[1]['spider'], 'myspider')
+        self.assertFalse(mware._item_types[Request])
+
     def test_mware_override(self):
         settings = {
             "MAGIC_FIELDS": {"spider": "$spider:name"},
@@ -139,6 +264,34 @@ class MagicFieldsTest(TestCase):
         }
         self.assertEqual(result, expected)
 
+    def test_pipeline(self):
+        settings = {"MAGIC_FIELDS": {
+            "spider": "$spider:name",
+            "sku": "$field:url,r'item_no=(\d+)'",
+            "prix": "$response:url",
+        }}
+        crawler = get_crawler(settings_dict=settings)
+        pipeline = MagicFieldsPipeline.from_crawler(crawler)
+        item = {'nom': 'myitem', "url": "http://www.example.com/product.html?item_no=345"}
+        result = pipeline.process_item(item, self.spider)
+        self.assertIs(result, item)
+        self.assertEqual(result, {
+            'nom': 'myitem',
+            'url': 'http://www.example.com/product.html?item_no=345',
+            'spider': 'myspider',
+            'sku': '345',
+        })
+
+    def test_pipeline_other_items(self):
+        class OtherItem(object):
+            pass
+
+        settings = {"MAGIC_FIELDS": {"spider": "$spider:name"}}
+        crawler = get_crawler(settings_dict=settings)
+        pipeline = MagicFieldsPipeline.from_crawler(crawler)
+        item = OtherItem()
+        self.assertIs(pipeline.process_item(item, self.spider), item)
+        self.assertFalse(hasattr(item, 'spider'))
 
 class MagicFieldsDictItemTest(MagicFieldsTest):
 